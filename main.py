@@ -33,21 +33,34 @@ TODO:
     - deal with the situation where create_bytearray would result in a bytearray the size larger than the universe. better would be to make some object that when you ask for an index or the next byte, it GENRATES it, is writable, etc...
 '''
 # stdlib
-from __future__ import print_function, division
 import os
+import re
+import csv
 import sys
+import platform
 import argparse
 import logging
-import copy
+import errno
+import mmap
+import ctypes
 import random
 import time
 import threading
+import itertools
 import multiprocessing
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional, Iterator, Callable
 
 # 3rd party
-import pandas as pd
 import psutil
+try:
+    import liburing  # linux only, optional, see io_uring_init
+except ImportError:
+    liburing = None
+try:
+    import fcntl  # posix only, but so is O_DIRECT
+except ImportError:
+    fcntl = None
 
 TEMP_DIRPATH = '/temp' if sys.platform == 'win32' else '/tmp'
 TEMP_DIRPATH = os.path.abspath(TEMP_DIRPATH)
@@ -56,46 +69,394 @@ DATA_FILEPATH = os.path.join(TEMP_DIRPATH, 'data.dat')
 PERF_FILEPATH = os.path.join(TEMP_DIRPATH, 'perf.csv')
 OPERATIONS = ['perf', 'fill', 'perf+fill', 'loop', 'write', 'perf+write']
 CPU_COUNT = multiprocessing.cpu_count()
+WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)  # O_BINARY only exists (and matters) on windows
+ALIGNMENT = 4096  # O_DIRECT wants buffer address, length, and file offset aligned to the logical block size
+DISK_USAGE_PROBE_INTERVAL = 32  # writes between statvfs calls while filling
+FADVISE_INTERVAL = 64 * 1024**2  # bytes written between fdatasync + POSIX_FADV_DONTNEED
+PREALLOCATE_HEADROOM = 64 * 1024**2  # left out of the up front reservation, filled by watching the free space instead
+IO_URING_ENTRIES = 64
+WRITE_BATCH = 64  # os.write calls between checks of the loop condition...
+IO_URING_BATCH = 32  # ...or writes per io_uring_enter...
+BATCH_BYTES = 64 * 1024**2  # ...unless that would be more than this, big arrays get fewer per batch
+IO_URING_MIN_KERNEL = (5, 10)
 LOG_LEVELS = list(logging._nameToLevel)  # pylint: disable=(protected-access)
 LOG_LEVEL = 'INFO'
 FILL = -1
 DURATION = 2
 ITERATIONS = 5
 SIZE = 1
+THREADS = 1
+MAX_AUTO_THREADS = 8  # --threads 0 picks min(CPU_COUNT, this)
+SWEETSPOT_REGRESSION = 0.8  # perf stops once the rate falls under this fraction of the best so far...
+SWEETSPOT_PATIENCE = 2  # ...this many sizes in a row
+LIBC = ctypes.CDLL(None, use_errno=True) if sys.platform == 'linux' else None
+PARALLEL_SWEEP_WORKERS = 4  # the workers mostly wait on the device, so not tied to CPU_COUNT
 
 class NiceFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawTextHelpFormatter, argparse.RawDescriptionHelpFormatter):
     pass
 
 def create_bytearray(count, fill=FILL):
     if fill == FILL:
-        new = bytearray(random.randint(0, 255) for _ in range(count))
+        new = bytearray(os.urandom(count))
     else:
-        new = bytearray(fill for _ in range(count))
+        new = bytearray(bytes((fill, )) * count)
     return new
 
 def create_bytearray_killobytes(count, fill=FILL):
+    # type: (int, int) -> bytearray
     '''
     Description:
-        create a bytearray by repeating only 1kb until the requested count
-        the motivation is i've found generating 1MB takes about .15s, but generating 10MB takes 20s, so its not growing linearly.
+        create a bytearray of count kb by repeating a single 1kb block
+        bytearray * count is one allocation filled by doubling memcpys, no python level loop
     '''
     logging.debug('%s, fill=%s', count, fill)
-    killobyte = create_bytearray(1024, fill=fill)
-    killobytes_array = bytearray()
-    for _ in range(count):
-        killobytes_array.extend(copy.deepcopy(killobyte))
+    killobytes_array = create_bytearray(1024, fill=fill) * count
     logging.debug('created byte array of size %0.3f MB', len(killobytes_array) / 1024**2)
     return killobytes_array
 
-def disk_usage_monitor(event, drive=DRIVE):
-    # type: (threading.Event, str) -> None
+def create_aligned_buffer(byte_array, alignment=ALIGNMENT):
+    # type: (bytearray, int) -> mmap.mmap
+    '''
+    Description:
+        copy a bytearray into page-aligned memory (anonymous mmap) so it can be written with O_DIRECT
+        the length is rounded up to a multiple of alignment, padding is filled by repeating the byte_array from the start
+    '''
+    byte_array_bytes = len(byte_array)
+    aligned_bytes = -(-byte_array_bytes // alignment) * alignment
+    aligned = mmap.mmap(-1, aligned_bytes)
+    offset = 0
+    while offset < aligned_bytes:
+        chunk = min(byte_array_bytes, aligned_bytes - offset)
+        aligned[offset:offset + chunk] = byte_array[:chunk]
+        offset += chunk
+    logging.debug('aligned byte array of size %s to %s', byte_array_bytes, aligned_bytes)
+    return aligned
+
+def open_for_fill(data_filepath, direct_io=False, readable=False):
+    # type: (str, bool, bool) -> Tuple[int, bool]
+    '''
+    Description:
+        open data_filepath for writing at explicit offsets (no O_APPEND), optionally bypassing the page cache with O_DIRECT
+        falls back to buffered writes if the platform or filesystem (tmpfs, some overlayfs) rejects O_DIRECT,
+        or if the file already ends off an ALIGNMENT boundary, the fill appends so every O_DIRECT write would be misaligned
+    Arguments:
+        readable: bool
+            O_RDWR instead of O_WRONLY, copy_file_range needs to read the source back
+    Returns:
+        Tuple[int, bool]
+            file descriptor, whether O_DIRECT is in effect
+    '''
+    flags = (os.O_RDWR if readable else os.O_WRONLY) | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    if direct_io:
+        if not hasattr(os, 'O_DIRECT'):
+            logging.warning('O_DIRECT is not supported on %s, falling back to buffered writes', sys.platform)
+        else:
+            try:
+                fd = os.open(data_filepath, flags | os.O_DIRECT, 0o644)
+            except OSError as ose:
+                if ose.errno != errno.EINVAL:
+                    raise
+                logging.warning('"%s" does not support O_DIRECT, falling back to buffered writes', data_filepath)
+            else:
+                size = os.fstat(fd).st_size
+                if size % ALIGNMENT == 0:
+                    return fd, True
+                logging.warning('"%s" is %s bytes, not a multiple of %s, falling back to buffered writes', data_filepath, size, ALIGNMENT)
+                disable_direct_io(fd)
+                return fd, False
+    fd = os.open(data_filepath, flags, 0o644)
+    fadvise_sequential(fd)
+    return fd, False
+
+def disable_direct_io(fd):
+    # type: (int) -> None
+    '''
+    Description:
+        clear O_DIRECT on an already open fd (linux lets F_SETFL toggle it) and carry on with buffered writes
+    '''
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+    fadvise_sequential(fd)
+
+def fadvise_sequential(fd):
+    # type: (int) -> None
+    '''
+    Description:
+        tell the kernel fd is going to be accessed sequentially, no-op where posix_fadvise doesn't exist (windows, macos)
+    '''
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+def drop_written_pages(fd, flushed, offset, interval=FADVISE_INTERVAL):
+    # type: (int, int, int, int) -> int
+    '''
+    Description:
+        once at least interval bytes past flushed have been written, fdatasync and POSIX_FADV_DONTNEED [flushed, offset)
+        so written pages leave the page cache instead of piling up as dirty until the kernel stalls the writer for writeback
+    Returns:
+        int
+            the new flushed offset
+    '''
+    if offset - flushed < interval or not hasattr(os, 'posix_fadvise'):
+        return flushed
+    os.fdatasync(fd)
+    os.posix_fadvise(fd, flushed, offset - flushed, os.POSIX_FADV_DONTNEED)
+    return offset
+
+def lseek_and_write(fd, data, offset):
+    # type: (int, bytes, int) -> int
+    '''
+    Description:
+        stand-in for os.pwrite where it doesn't exist (windows), moves the file position so don't share fd between threads
+    '''
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+pwrite = getattr(os, 'pwrite', lseek_and_write)
+
+def fallocate(fd, offset, length):
+    # type: (int, int, int) -> None
+    '''
+    Description:
+        the fallocate(2) syscall where it can be called directly (linux), os.posix_fallocate elsewhere
+        glibc's posix_fallocate quietly falls back to writing a byte into every block on filesystems without fallocate
+        (ext2/3, vfat, older nfs), for the whole free space that is writing the disk twice before the fill has even started,
+        the syscall raises EOPNOTSUPP instead
+    '''
+    libc_fallocate = getattr(LIBC, 'fallocate64', None) or getattr(LIBC, 'fallocate', None)
+    if libc_fallocate is None:
+        os.posix_fallocate(fd, offset, length)
+        return
+    libc_fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    if libc_fallocate(fd, 0, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+def preallocate(fd, offset, length):
+    # type: (int, int, int) -> int
+    '''
+    Description:
+        reserve length bytes from offset with fallocate so the filesystem can hand out large contiguous extents up front
+        instead of growing the file (and journaling the metadata) write by write
+        nothing is reserved where the filesystem can't do it natively, see fallocate
+    Returns:
+        int
+            end offset of the reservation, offset itself if nothing was reserved
+    '''
+    if length <= 0 or not hasattr(os, 'posix_fallocate'):
+        return offset
+    try:
+        fallocate(fd, offset, length)
+    except OSError as ose:
+        logging.warning('could not preallocate %0.3f MB (%s), writing without it', length / 1024**2, ose)
+        return offset
+    logging.debug('preallocated %0.3f MB', length / 1024**2)
+    return offset + length
+
+def io_uring_init(entries=IO_URING_ENTRIES, sqpoll=False):
+    # type: (int, bool) -> Optional[liburing.Ring]
+    '''
+    Description:
+        set up an io_uring instance if this platform can do it, otherwise return None so the caller falls back to os.write
+        needs linux >= 5.10 and the liburing bindings (pip install liburing)
+    Arguments:
+        sqpoll: bool
+            IORING_SETUP_SQPOLL, a kernel thread polls the submission queue so submitting needs no syscall while it is awake
+            it sleeps after the kernel default of 1s idle, the bindings do not expose sq_thread_idle/sq_thread_cpu
+            needs CAP_SYS_ADMIN before 5.11, if refused we retry without it
+    '''
+    if liburing is None or sys.platform != 'linux':
+        return None
+    match = re.match(r'(\d+)\.(\d+)', platform.release())
+    if match is None or tuple(int(ele) for ele in match.groups()) < IO_URING_MIN_KERNEL:
+        logging.debug('kernel %s is too old for io_uring, falling back to os.write', platform.release())
+        return None
+    ring = liburing.Ring()
+    try:
+        liburing.io_uring_queue_init(entries, ring, liburing.IORING_SETUP_SQPOLL if sqpoll else 0)
+    except OSError as ose:
+        if sqpoll and ose.errno == errno.EPERM:
+            logging.warning('not allowed to use SQPOLL (%s), retrying without it', ose)
+            return io_uring_init(entries=entries)
+        if ose.errno not in (errno.ENOSYS, errno.EPERM):
+            raise
+        logging.warning('io_uring is unavailable (%s), falling back to os.write', ose)
+        return None
+    return ring
+
+def io_uring_register(ring, fd, byte_array):
+    # type: (liburing.Ring, int, bytearray) -> bool
+    '''
+    Description:
+        register byte_array as fixed buffer 0 and fd as fixed file 0 so the kernel pins them once for the life of the ring
+        rather than mapping the buffer and looking up the fd on every write
+        byte_array must stay alive and must not be resized until the ring is torn down
+    Returns:
+        bool
+            True if both got registered and io_uring_write can use fixed=True
+    '''
+    try:
+        liburing.io_uring_register_buffers(ring, liburing.Iovec([byte_array]))
+        liburing.io_uring_register_files(ring, liburing.FileIndex([fd]))
+    except OSError as ose:
+        # ENOMEM from RLIMIT_MEMLOCK on older kernels, EINVAL past the 1GB per-buffer limit
+        logging.debug('could not register fixed buffer/file (%s), using regular io_uring writes', ose)
+        return False
+    return True
+
+def io_uring_write(ring, fd, byte_array, count, offset=0, fixed=False):
+    # type: (liburing.Ring, int, bytearray, int, int, bool) -> int
+    '''
+    Description:
+        queue count writes of byte_array back to back starting at offset, submit them with a single io_uring_enter and wait for all of them
+        if fd was opened with O_APPEND the kernel ignores the offset and every write lands at the end of the file
+    Arguments:
+        fixed: bool
+            use the buffer and file registered by io_uring_register
+    Returns:
+        int
+            bytes written
+    '''
+    cqe = liburing.Cqe()
+    byte_array_bytes = len(byte_array)
+    for i in range(count):
+        sqe = liburing.io_uring_get_sqe(ring)
+        if fixed:
+            liburing.io_uring_prep_write_fixed(sqe, 0, byte_array, 0, offset + i * byte_array_bytes)
+            liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_FIXED_FILE)
+        else:
+            liburing.io_uring_prep_write(sqe, fd, byte_array, offset + i * byte_array_bytes)
+    liburing.io_uring_submit(ring)
+    bytes_written = 0
+    error = None
+    # one completion at a time, cqe[i] doesn't apply the ring mask so a batch that wraps the completion queue reads stale slots
+    for _ in range(count):
+        liburing.io_uring_wait_cqe(ring, cqe)
+        entry = cqe[0]
+        try:
+            bytes_written += entry.res  # raises the OSError if that write failed
+        except OSError as ose:
+            error = error or ose  # keep reaping, the rest of the batch still has to leave the queue
+        finally:
+            liburing.io_uring_cqe_seen(ring, entry)
+    if error is not None:
+        raise error
+    return bytes_written
+
+def fill_with_copy_file_range(fd, byte_array, drive=DRIVE):
+    # type: (int, bytearray, str) -> None
+    '''
+    Description:
+        write byte_array once at the end of fd, then keep duplicating that region in-kernel with copy_file_range until the disk is nearly full
+        the data never goes back through userspace, fd has to be readable and must not be O_APPEND (see open_for_fill)
+        stops early and leaves the rest to the caller if copy_file_range is unsupported here,
+        or if the filesystem answers with reflinks (btrfs, xfs) since shared extents use no space and the disk would never fill
+        on return the file position is at the end of what was written
+    '''
+    byte_array_bytes = len(byte_array)
+    src_offset = os.lseek(fd, 0, os.SEEK_END)
+    offset = src_offset + os.write(fd, byte_array)
+    free = probed = psutil.disk_usage(drive).free
+    writes = 0
+    flushed = src_offset
+    try:
+        while free > byte_array_bytes:
+            copied = os.copy_file_range(fd, fd, byte_array_bytes, src_offset, offset)
+            if copied == 0:
+                break
+            offset += copied
+            free -= copied
+            flushed = drop_written_pages(fd, flushed, offset)
+            writes += 1
+            if writes >= DISK_USAGE_PROBE_INTERVAL:
+                free = psutil.disk_usage(drive).free
+                if free >= probed:
+                    logging.warning('copy_file_range is reflinking instead of copying, falling back to os.write')
+                    break
+                probed = free
+                writes = 0
+    except OSError as ose:
+        if ose.errno not in (errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+        logging.warning('copy_file_range is not supported here (%s), falling back to os.write', ose)
+    finally:
+        os.lseek(fd, offset, os.SEEK_SET)
+
+def pwrite_concurrently(fd, byte_array, threads, batch, iterations, deadline_ns):
+    # type: (int, bytearray, int, int, int, int) -> int
+    '''
+    Description:
+        have threads writers pwrite byte_array back to back into fd, each claiming the next batch of slots from a shared counter
+        pwrite releases the GIL so the writes really are in flight together, which is what gets nvme past queue depth 1
+        the writers stop once iterations slots are claimed and perf_counter_ns is past deadline_ns, that is decided under
+        the same lock as the claim so no batch is handed out after it and what gets written is one run from offset 0 without holes
+        like the single thread loop, batches don't run past iterations until only the deadline is left
+        the prefix every writer has finished goes through drop_written_pages, the same flush policy as the single thread loop
+    Returns:
+        int
+            bytes written
+    '''
+    mv = memoryview(byte_array)
+    byte_array_bytes = len(mv)
+    lock = threading.Lock()
+    claimed = 0  # slots handed out
+    completed = 0  # slots written with nothing missing below
+    finished = {}  # first slot: slots, for batches written past completed
+    flushed = 0
+    stopped = False
+
+    def writer():
+        # type: () -> int
+        nonlocal claimed, completed, flushed, stopped
+        written = 0
+        while True:
+            with lock:
+                stopped = stopped or (claimed >= iterations and time.perf_counter_ns() >= deadline_ns)
+                if stopped:
+                    return written
+                first = claimed
+                count = min(batch, iterations - claimed) if claimed < iterations else batch
+                claimed += count
+            try:
+                for slot in range(first, first + count):
+                    written += os.pwrite(fd, mv, slot * byte_array_bytes)
+            except BaseException:
+                with lock:
+                    stopped = True  # a hole is coming regardless, at least don't keep the others writing past it
+                raise
+            with lock:
+                finished[first] = count
+                while completed in finished:
+                    completed += finished.pop(completed)
+                flush_from, flush_to = flushed, completed * byte_array_bytes
+                if flush_to - flush_from >= FADVISE_INTERVAL:
+                    flushed = flush_to  # claimed for this writer, the others carry on from here
+            # outside the lock, the other writers keep going while this one waits on fdatasync
+            drop_written_pages(fd, flush_from, flush_to)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(writer) for _ in range(threads)]
+    return sum(future.result() for future in futures)
+
+def disk_usage_monitor(event, drive=DRIVE, unwritten=None):
+    # type: (threading.Event, str, Optional[Callable[[], int]]) -> None
+    '''
+    Description:
+        log the disk usage once a second until event is set
+    Arguments:
+        unwritten: Callable[[], int]
+            bytes reserved with posix_fallocate but not written yet, they already count as used
+            so while there are any, the usage that has actually been written is logged next to it
+    '''
     while not event.is_set():
         du = psutil.disk_usage(drive)
-        logging.info('disk usage: %s%%', du.percent)
-        for _ in range(100):
-            time.sleep(1 / 100)
-            if event.is_set():
-                break
+        reserved_bytes = unwritten() if unwritten is not None else 0
+        if reserved_bytes > 0:
+            written_percent = (du.used - reserved_bytes) / (du.used + du.free) * 100
+            logging.info('disk usage: %0.1f%% written, %s%% reserved', written_percent, du.percent)
+        else:
+            logging.info('disk usage: %s%%', du.percent)
+        if event.wait(timeout=1.0):
+            break
 
 def validate_kwargs(
     operation=OPERATIONS[0],
@@ -105,6 +466,11 @@ def validate_kwargs(
     duration=DURATION,
     iterations=ITERATIONS,
     no_optimizations=False,
+    direct_io=False,
+    sqpoll=False,
+    parallel_sweep=False,
+    copy_file_range=False,
+    threads=THREADS,
     data_filepath=DATA_FILEPATH,
     perf_filepath=PERF_FILEPATH
 ):
@@ -121,14 +487,24 @@ def validate_kwargs(
         raise ValueError('duration must be a postive num, are you nuts?')
     if iterations < 0:
         raise ValueError('iterations must be a postive int, are you nuts?')
+    if threads < 0:
+        raise ValueError('threads must be a postive int or 0 for auto, are you nuts?')
     if not isinstance(no_optimizations, bool):
         raise TypeError(f'no_optimizations must be of type bool, provided {type(no_optimizations)}')
+    if not isinstance(direct_io, bool):
+        raise TypeError(f'direct_io must be of type bool, provided {type(direct_io)}')
+    if not isinstance(sqpoll, bool):
+        raise TypeError(f'sqpoll must be of type bool, provided {type(sqpoll)}')
+    if not isinstance(parallel_sweep, bool):
+        raise TypeError(f'parallel_sweep must be of type bool, provided {type(parallel_sweep)}')
+    if not isinstance(copy_file_range, bool):
+        raise TypeError(f'copy_file_range must be of type bool, provided {type(copy_file_range)}')
     for filepath in [data_filepath, perf_filepath]:
         if not os.path.isdir(os.path.dirname(filepath)):
             os.makedirs(os.path.dirname(filepath))
 
-def write_byte_array_continuously(byte_array, data_filepath=DATA_FILEPATH, duration=DURATION, iterations=ITERATIONS):
-    # type: (bytearray, str, float, int) -> Tuple[int, float, int]
+def write_byte_array_continuously(byte_array, data_filepath=DATA_FILEPATH, duration=DURATION, iterations=ITERATIONS, sqpoll=False, threads=THREADS):
+    # type: (bytearray, str, float, int, bool, int) -> Tuple[int, float, int]
     '''
     Description:
         given a bytearray, write it to the disk in write mode fashion until the duration or iterations has been exceeded
@@ -137,69 +513,215 @@ def write_byte_array_continuously(byte_array, data_filepath=DATA_FILEPATH, durat
             in seconds, how long should it go for? exec ends after duration exceeded or iteration exceeded
         iteration: int
             in ints, many times? exec ends after duration exceeded or iteration exceeded
+        sqpoll: bool
+            if writing through io_uring, let a kernel thread poll the submission queue
+        threads: int
+            more than 1 writes from that many threads with pwrite at disjoint offsets instead (no io_uring), see pwrite_concurrently
+            0 picks min(CPU_COUNT, MAX_AUTO_THREADS)
     Returns:
         Tuple[int, float, int]
             bytes written, elapsed in seconds, iterations achieved
     '''
-    validate_kwargs(data_filepath=data_filepath, duration=duration, iterations=iterations)
-    logging.info('data_filepath="%s", duration=%s, iterations=%s', data_filepath, duration, iterations)
-    with open(data_filepath, 'wb'):
-        pass
-    original_size = os.path.getsize(data_filepath)
-    with open(data_filepath, 'wb') as wb:
-        start = time.time()
+    validate_kwargs(data_filepath=data_filepath, duration=duration, iterations=iterations, sqpoll=sqpoll, threads=threads)
+    if threads == 0:
+        threads = min(CPU_COUNT, MAX_AUTO_THREADS)
+    if threads > 1 and not hasattr(os, 'pwrite'):
+        logging.warning('os.pwrite is not supported on %s, writing from a single thread', sys.platform)
+        threads = 1
+    logging.info('data_filepath="%s", duration=%s, iterations=%s, sqpoll=%s, threads=%s', data_filepath, duration, iterations, sqpoll, threads)
+    # O_TRUNC empties the file on open, no need to open it once just to truncate
+    fd = os.open(data_filepath, WRITE_FLAGS | os.O_TRUNC, 0o644)
+    ring = None
+    try:
+        fadvise_sequential(fd)
+        ring = io_uring_init(sqpoll=sqpoll) if threads == 1 else None
+        fixed = ring is not None and io_uring_register(ring, fd, byte_array)
+        batch = max(1, min(IO_URING_BATCH if ring is not None else WRITE_BATCH, BATCH_BYTES // len(byte_array)))
+        mv = memoryview(byte_array)
+        # perf_counter_ns is monotonic and fine grained everywhere, time.time ticks every ~15.6ms on windows
+        duration_ns = int(duration * 1_000_000_000)
+        start = time.perf_counter_ns()
         iteration = 0
-        while time.time() - start < duration or iteration < iterations:
-            wb.write(byte_array)
-            iteration += 1
-        end = time.time()
-    bytes_written = os.path.getsize(data_filepath) - original_size
-    elapsed = end - start
+        # counted in process rather than stat'ing the file around the timed region, the file started out empty
+        bytes_written = 0
+        flushed = 0
+        if threads > 1:
+            bytes_written = pwrite_concurrently(fd, byte_array, threads, batch, iterations, start + duration_ns)
+            iteration = bytes_written // len(byte_array)
+        else:
+            # checked once per batch, and the clock is only read once the iterations are done
+            while iteration < iterations or time.perf_counter_ns() - start < duration_ns:
+                # the last batch before the iterations are reached is cut short, only the duration runs on in whole batches
+                count = min(batch, iterations - iteration) if iteration < iterations else batch
+                if ring is not None:
+                    bytes_written += io_uring_write(ring, fd, byte_array, count, offset=bytes_written, fixed=fixed)
+                else:
+                    for _ in range(count):
+                        bytes_written += os.write(fd, mv)
+                iteration += count
+                flushed = drop_written_pages(fd, flushed, bytes_written)
+        end = time.perf_counter_ns()
+        if threads > 1:
+            os.fsync(fd)  # outside the timed region, just making sure every writer's data actually landed
+        file_bytes = os.fstat(fd).st_size
+        if file_bytes != bytes_written:
+            logging.warning('counted %s bytes written but "%s" is %s bytes', bytes_written, data_filepath, file_bytes)
+    finally:
+        if ring is not None:
+            liburing.io_uring_queue_exit(ring)
+        os.close(fd)
+    elapsed = (end - start) / 1_000_000_000
     throughput = bytes_written / 1024**2 / elapsed
     logging.debug('bytes_written=%s, elapsed=%s, iteration=%s, throughput=%0.3f MB/s', bytes_written, elapsed, iteration, throughput)
     return bytes_written, elapsed, iteration
 
-def write_byte_array_contiguously(byte_array, data_filepath=DATA_FILEPATH):
-    # type: (bytearray, str) -> None
+def write_byte_array_contiguously(byte_array, data_filepath=DATA_FILEPATH, direct_io=False, sqpoll=False, copy_file_range=False):
+    # type: (bytearray, str, bool, bool, bool) -> None
     '''
     Description:
         given a bytearray, write it to the disk in an appending fashion, and when you inevitably overshoot, fill in 1mb increments
+        all but PREALLOCATE_HEADROOM of the free space is reserved up front with posix_fallocate and written at explicit offsets,
+        so the disk usage jumps right away, the rest is written watching the free space like before
     Arguments:
+        direct_io: bool
+            open with O_DIRECT and write from an aligned buffer so the data skips the page cache
+        sqpoll: bool
+            if writing through io_uring, let a kernel thread poll the submission queue
+        copy_file_range: bool
+            write byte_array once and duplicate it in-kernel from there, see fill_with_copy_file_range
+            takes precedence over direct_io, io_uring, and preallocation
     Returns:
     '''
-    validate_kwargs(data_filepath=data_filepath)
-    logging.info('data_filepath="%s"', data_filepath)
+    validate_kwargs(data_filepath=data_filepath, direct_io=direct_io, sqpoll=sqpoll, copy_file_range=copy_file_range)
+    logging.info('data_filepath="%s", direct_io=%s, sqpoll=%s, copy_file_range=%s', data_filepath, direct_io, sqpoll, copy_file_range)
+    if copy_file_range and not hasattr(os, 'copy_file_range'):
+        logging.warning('copy_file_range is not supported on %s, falling back to os.write', sys.platform)
+        copy_file_range = False
 
-    drive, _ = os.path.splitdrive(os.path.abspath(data_filepath))
+    # disk_usage wants a path on the volume, splitdrive gives '' on posix
+    drive = os.path.dirname(os.path.abspath(data_filepath))
 
     one_mb_bytes = (1024**2)
-    byte_array_bytes = len(byte_array)
-    event = threading.Event()
-    t = threading.Thread(target=disk_usage_monitor, args=(event, ), kwargs=dict(drive=drive), daemon=True)
-    t.start()
+    fd, direct_io = open_for_fill(data_filepath, direct_io=direct_io and not copy_file_range, readable=copy_file_range)
+    fadvise_interval = sys.maxsize if direct_io else FADVISE_INTERVAL  # O_DIRECT leaves nothing in the page cache to drop
+
+    def write_at(data, at):
+        # type: (memoryview, int) -> int
+        # some devices want a bigger alignment than ALIGNMENT, that only shows up as EINVAL on the write
+        nonlocal direct_io, fadvise_interval
+        try:
+            return pwrite(fd, data, at)
+        except OSError as ose:
+            if not direct_io or ose.errno != errno.EINVAL:
+                raise
+            logging.warning('O_DIRECT write at offset %s failed (%s), falling back to buffered writes', at, ose)
+        disable_direct_io(fd)
+        direct_io = False
+        fadvise_interval = FADVISE_INTERVAL
+        return pwrite(fd, data, at)
+
+    ring = mv = None
     try:
-        with open(data_filepath, 'ab') as wb:
-            while psutil.disk_usage(drive).free > byte_array_bytes:
-                wb.write(byte_array)
-        # writing in 1mb chunks
-        with open(data_filepath, 'ab') as wb:
+        if direct_io:
+            byte_array = create_aligned_buffer(byte_array)
+        # the bindings only take bytes/bytearray, an aligned mmap buffer has to go through os.write
+        ring = None if direct_io or copy_file_range else io_uring_init(sqpoll=sqpoll)
+        fixed = ring is not None and io_uring_register(ring, fd, byte_array)
+        mv = memoryview(byte_array)
+        byte_array_bytes = len(mv)
+        batch = max(1, min(IO_URING_BATCH, BATCH_BYTES // byte_array_bytes))
+        offset = reserved = flushed = os.lseek(fd, 0, os.SEEK_END)
+        event = threading.Event()
+        t = threading.Thread(target=disk_usage_monitor, args=(event, ), kwargs=dict(drive=drive, unwritten=lambda: reserved - offset), daemon=True)
+        t.start()
+        try:
+            if copy_file_range:
+                # it tells reflinks apart by watching free space go down, a reservation would hide that
+                fill_with_copy_file_range(fd, byte_array, drive=drive)
+                offset = os.lseek(fd, 0, os.SEEK_CUR)
+            else:
+                # the reserved space can't run out, so no need to watch the free space until it's written
+                reserved = preallocate(fd, offset, psutil.disk_usage(drive).free - PREALLOCATE_HEADROOM)
+                if ring is not None:
+                    while offset + byte_array_bytes * batch <= reserved:
+                        offset += io_uring_write(ring, fd, byte_array, batch, offset=offset, fixed=fixed)
+                        flushed = drop_written_pages(fd, flushed, offset, interval=fadvise_interval)
+                while offset + byte_array_bytes <= reserved:
+                    offset += write_at(mv, offset)
+                    flushed = drop_written_pages(fd, flushed, offset, interval=fadvise_interval)
+            # free space is tracked by subtraction and only re-probed every so often to correct for other writers
+            # the unwritten end of the reservation is already counted as used, so start from there
+            free = psutil.disk_usage(drive).free + reserved - offset
+            writes = 0
+            if ring is not None:
+                while free > byte_array_bytes * batch:
+                    written = io_uring_write(ring, fd, byte_array, batch, offset=offset, fixed=fixed)
+                    offset += written
+                    free -= written
+                    flushed = drop_written_pages(fd, flushed, offset, interval=fadvise_interval)
+                    writes += batch
+                    if writes >= DISK_USAGE_PROBE_INTERVAL:
+                        free = psutil.disk_usage(drive).free + max(0, reserved - offset)
+                        writes = 0
+                free = psutil.disk_usage(drive).free + max(0, reserved - offset)
+            while free > byte_array_bytes:
+                written = write_at(mv, offset)
+                offset += written
+                free -= written
+                flushed = drop_written_pages(fd, flushed, offset, interval=fadvise_interval)
+                writes += 1
+                if writes >= DISK_USAGE_PROBE_INTERVAL:
+                    free = psutil.disk_usage(drive).free + max(0, reserved - offset)
+                    writes = 0
+            # writing in 1mb chunks, slices of an aligned buffer stay aligned
             for i in range(byte_array_bytes // one_mb_bytes):
-                if psutil.disk_usage(drive).free > one_mb_bytes:
-                    one_mb_array = byte_array[i * one_mb_bytes:(i + 1) * one_mb_bytes]
-                    wb.write(one_mb_array)
+                if psutil.disk_usage(drive).free + max(0, reserved - offset) > one_mb_bytes:
+                    offset += write_at(mv[i * one_mb_bytes:(i + 1) * one_mb_bytes], offset)
                 else:
                     break
-    except KeyboardInterrupt:
-        logging.info('cancelling')
-    except OSError:
-        logging.info('done')
+        except KeyboardInterrupt:
+            logging.info('cancelling')
+        except OSError:
+            logging.info('done')
+        finally:
+            event.set()
+            if reserved > offset:
+                # cancelled (or failed) partway through the reservation, don't leave the unwritten part behind
+                os.ftruncate(fd, offset)
     finally:
-        event.set()
+        if ring is not None:
+            liburing.io_uring_queue_exit(ring)
+        if mv is not None:
+            mv.release()
+        os.close(fd)
     du = psutil.disk_usage(drive)
     logging.debug('disk usage: %s%%', du.percent)
 
-def create_byte_array_high_throughput(data_filepath=DATA_FILEPATH, perf_filepath=PERF_FILEPATH, fill=FILL):
-    # type: (str, str, int) -> bytearray
+def benchmark_killobytes(killobytes, data_filepath=DATA_FILEPATH, fill=FILL, sqpoll=False, threads=THREADS, barrier=None):
+    # type: (int, str, int, bool, int, Optional[threading.Barrier]) -> Tuple[dict, bytearray]
+    '''
+    Description:
+        create a byte_array of killobytes and measure how fast it can be written continuously to data_filepath
+    Arguments:
+        barrier: threading.Barrier
+            if given, wait on it between creating the byte_array and the timed writes
+    Returns:
+        Tuple[dict, bytearray]
+            perf row, the byte_array that was measured
+    '''
+    megabytes = killobytes / 1024
+    byte_array = create_bytearray_killobytes(killobytes, fill=fill)
+    if barrier is not None:
+        barrier.wait()
+    bytes_written_bytes, elapsed, iteration = write_byte_array_continuously(byte_array, data_filepath, sqpoll=sqpoll, threads=threads)
+    bytes_written_mb = bytes_written_bytes / 1024**2
+    rate = bytes_written_mb / elapsed
+    logging.info('%s kb - %0.3f mb - %0.3f mb/s over %0.3f sec - iteration %s', killobytes, megabytes, rate, elapsed, iteration)
+    row = {'kb': killobytes, 'mb': megabytes, 'rate': rate, 'elapsed': elapsed, 'iteration': iteration}
+    return row, byte_array
+
+def create_byte_array_high_throughput(data_filepath=DATA_FILEPATH, perf_filepath=PERF_FILEPATH, fill=FILL, sqpoll=False, parallel_sweep=False, threads=THREADS):
+    # type: (str, str, int, bool, bool, int) -> bytearray
     '''
     Description:
         create a bunch of byte_arrays of different sizes and pick the one with the highest write throughput
@@ -207,34 +729,75 @@ def create_byte_array_high_throughput(data_filepath=DATA_FILEPATH, perf_filepath
         fill: int
             default -1
             from 0-255, do you want the bytes to be all the same, or -1 for random?
+        sqpoll: bool
+            if writing through io_uring, let a kernel thread poll the submission queue
+        parallel_sweep: bool
+            measure PARALLEL_SWEEP_WORKERS sizes at once, each against its own data_filepath.<kb> which is removed afterwards
+            a cohort starts its timed writes together and the next one waits for it to finish, so every size shares the device
+            with the same number of writers, rates are lower than a serial sweep and only meaningful relative to each other
+        threads: int
+            writer threads per size, see write_byte_array_continuously
     Returns:
         bytearray
     '''
-    validate_kwargs(fill=fill, data_filepath=data_filepath, perf_filepath=perf_filepath)
-    logging.info('data_filepath="%s", perf_filepath="%s", fill=%s', data_filepath, perf_filepath, fill)
-    rows = []
+    validate_kwargs(fill=fill, data_filepath=data_filepath, perf_filepath=perf_filepath, sqpoll=sqpoll, parallel_sweep=parallel_sweep, threads=threads)
+    logging.info('data_filepath="%s", perf_filepath="%s", fill=%s, parallel_sweep=%s', data_filepath, perf_filepath, fill, parallel_sweep)
     sweetspot_bytearray = bytearray()
     sweetspot_killobytes = 0
     sweetspot_rate = 0.0
-    killobytes_list = [1, 4, 32, 128]
-    killobytes_list.extend([1024 * ele for ele in killobytes_list])
-    killobytes_list.extend([ele * 2 for ele in killobytes_list] + [ele * 3 for ele in killobytes_list])
-    for killobytes in sorted(killobytes_list):
-        megabytes = killobytes / 1024
-        byte_array = create_bytearray_killobytes(killobytes, fill=fill)
-        bytes_written_bytes, elapsed, iteration = write_byte_array_continuously(byte_array, data_filepath)
-        bytes_written_mb = bytes_written_bytes / 1024**2
-        rate = bytes_written_mb / elapsed
-        if rate > sweetspot_rate:
-            sweetspot_rate = rate
-            sweetspot_killobytes = killobytes
-            sweetspot_bytearray = byte_array
-        logging.info('%s kb - %0.3f mb - %0.3f mb/s over %0.3f sec - iteration %s', killobytes, megabytes, rate, elapsed, iteration)
-        row = {'kb': killobytes, 'mb': megabytes, 'rate': rate, 'elapsed': elapsed, 'iteration': iteration}
-        rows.append(row)
-    df = pd.DataFrame(rows)
-    logging.debug('\n%s', df)
-    df.to_csv(perf_filepath)
+    # 1kb .. 384mb, each decade-ish step also tried at x2 and x3, deduplicated so no size costs DURATION twice
+    killobytes_list = sorted(set(base * multiplier for base in [1, 4, 32, 128, 1024, 4096, 32768, 131072] for multiplier in [1, 2, 3]))
+    consecutive_regressions = 0
+
+    def benchmark_killobytes_alone(killobytes, barrier):
+        # type: (int, threading.Barrier) -> Tuple[dict, bytearray]
+        filepath = f'{data_filepath}.{killobytes}'
+        try:
+            row, _ = benchmark_killobytes(killobytes, data_filepath=filepath, fill=fill, sqpoll=sqpoll, threads=threads, barrier=barrier)
+        except BaseException:
+            barrier.abort()  # don't leave the rest of the cohort waiting for a size that is never coming
+            raise
+        finally:
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+        return row, bytearray()  # don't hold every size in memory, the sweetspot gets recreated below
+
+    def benchmark_killobytes_in_cohorts():
+        # type: () -> Iterator[Tuple[dict, bytearray]]
+        # an unbroken pool would drain onto the largest sizes, which then have the device (almost) to themselves
+        with ThreadPoolExecutor(max_workers=PARALLEL_SWEEP_WORKERS) as executor:
+            for i in range(0, len(killobytes_list), PARALLEL_SWEEP_WORKERS):
+                cohort = killobytes_list[i:i + PARALLEL_SWEEP_WORKERS]
+                barrier = threading.Barrier(len(cohort))
+                yield from executor.map(benchmark_killobytes_alone, cohort, itertools.repeat(barrier))
+
+    if parallel_sweep:
+        results = benchmark_killobytes_in_cohorts()
+    else:
+        results = (benchmark_killobytes(killobytes, data_filepath=data_filepath, fill=fill, sqpoll=sqpoll, threads=threads) for killobytes in killobytes_list)
+
+    # rows are written as they come so a ctrl+c still leaves the sizes measured so far
+    with open(perf_filepath, 'w', newline='') as w:
+        writer = csv.DictWriter(w, fieldnames=['kb', 'mb', 'rate', 'elapsed', 'iteration'])
+        writer.writeheader()
+        for row, byte_array in results:
+            writer.writerow(row)
+            w.flush()
+            rate = row['rate']
+            if rate > sweetspot_rate:
+                sweetspot_rate = rate
+                sweetspot_killobytes = row['kb']
+                sweetspot_bytearray = byte_array
+            # throughput vs size is unimodal, once it has clearly fallen off twice in a row it isn't coming back
+            if rate < SWEETSPOT_REGRESSION * sweetspot_rate:
+                consecutive_regressions += 1
+                if consecutive_regressions >= SWEETSPOT_PATIENCE:
+                    logging.info('%s kb - stopping early, %s sizes in a row under %0.0f%% of the sweetspot', row['kb'], consecutive_regressions, SWEETSPOT_REGRESSION * 100)
+                    break
+            else:
+                consecutive_regressions = 0
+    if not sweetspot_bytearray:
+        sweetspot_bytearray = create_bytearray_killobytes(sweetspot_killobytes, fill=fill)
     logging.info('%s kb - %0.3f mb/s - sweetspot', sweetspot_killobytes, sweetspot_rate)
     return sweetspot_bytearray
 
@@ -246,20 +809,22 @@ def write_bytearray_to_disk(byte_array, size=-1, data_filepath=DATA_FILEPATH):
     '''
     if size == -1:
         size = len(byte_array)
-    with open(data_filepath, 'wb') as wb:
-        pass
     iterations = size // len(byte_array)
-    with open(data_filepath, 'ab') as wb:
-        for i in range(iterations):
+    # counted in process, getsize misses whatever is still sitting in the write buffer
+    bytes_written = 0
+    # slicing a memoryview shares the buffer, slicing the bytearray would copy it every time
+    mv = memoryview(byte_array)
+    with open(data_filepath, 'wb') as wb:
+        for _ in range(iterations):
             # basically "fake" randomness even further by starting at different points within the already created one.
             # if fill is provided, they're all constants anyway
             midpoint = random.randint(0, len(byte_array) - 1)
-            wb.write(byte_array[midpoint:])
-            wb.write(byte_array[0:midpoint])
-            logging.debug('%0.3f%% or %0.3f MB written', (i + 1) / (iterations + 1) * 100, os.path.getsize(data_filepath) / 1024**2)
-        remainder = size - os.path.getsize(data_filepath)
-        wb.write(byte_array[0:remainder])
-        logging.debug('%0.3f%% or %0.3f MB written', (i + 2) / (iterations + 1) * 100, os.path.getsize(data_filepath) / 1024**2)
+            bytes_written += wb.write(mv[midpoint:])
+            bytes_written += wb.write(mv[0:midpoint])
+            logging.debug('%0.3f%% or %0.3f MB written', bytes_written / size * 100, bytes_written / 1024**2)
+        remainder = size - bytes_written
+        bytes_written += wb.write(mv[0:remainder])
+        logging.debug('%0.3f%% or %0.3f MB written', bytes_written / size * 100, bytes_written / 1024**2)
 
 def generate_and_write_bytearray(size, fill=FILL, no_optimizations=False, data_filepath=DATA_FILEPATH):
     # type: (int, int, bool, str) -> bytearray
@@ -300,6 +865,8 @@ def main():
     op1.set_defaults(operation='fill')
     group = op1.add_argument_group('operation specific')
     group.add_argument('--size', type=int, default=SIZE, help='size in killobytes, so --size * 1024B')
+    group.add_argument('--direct-io', '--direct_io', action='store_true', help='bypass the page cache with O_DIRECT, falls back to buffered if unsupported.')
+    group.add_argument('--copy-file-range', '--copy_file_range', action='store_true', help='write the array once then duplicate it in-kernel, falls back to os.write on reflinking filesystems.')
 
     op2 = operations.add_parser(
         'perf+fill',
@@ -309,6 +876,8 @@ def main():
     )
     op2.set_defaults(operation='perf+fill')
     group = op2.add_argument_group('operation specific')
+    group.add_argument('--direct-io', '--direct_io', action='store_true', help='bypass the page cache with O_DIRECT, falls back to buffered if unsupported.')
+    group.add_argument('--copy-file-range', '--copy_file_range', action='store_true', help='write the array once then duplicate it in-kernel, falls back to os.write on reflinking filesystems.')
 
     op3 = operations.add_parser(
         'loop',
@@ -344,6 +913,18 @@ def main():
     group.add_argument('--size', type=int, default=SIZE, help='size in bytes')
     group.add_argument('--no-optimizations', '--no_optimizations', action='store_true', help='generate the FULL byte_array in memory, no matter how unreasonable.')
 
+    for op in [op0, op2, op5]:
+        group = op.add_argument_group('perf')
+        group.add_argument('--parallel-sweep', '--parallel_sweep', action='store_true', help='measure several sizes at once on separate files, in cohorts that share the bandwidth evenly, faster but rates are lower.')
+
+    for op in [op0, op2, op3, op5]:
+        group = op.add_argument_group('threads')
+        group.add_argument('--threads', type=int, default=THREADS, help=f'writer threads pwriting disjoint offsets to keep the queue deep, 0 means min(cpu count, {MAX_AUTO_THREADS}).')
+
+    for op in [op0, op1, op2, op3]:
+        group = op.add_argument_group('io_uring')
+        group.add_argument('--sqpoll', action='store_true', help='poll the submission queue from a kernel thread, only used if io_uring is available.')
+
     for op in [op0, op1, op2, op3, op4, op5]:
         group = op.add_argument_group('general')
         group.add_argument('--data-filepath', type=str, default=DATA_FILEPATH, help='where to dump the file that fills the disk.')
@@ -358,24 +939,24 @@ def main():
     logging.info('starting %r', args.operation)
 
     if args.operation == 'perf':
-        create_byte_array_high_throughput(fill=args.fill, data_filepath=args.data_filepath, perf_filepath=args.perf_filepath)
+        create_byte_array_high_throughput(fill=args.fill, data_filepath=args.data_filepath, perf_filepath=args.perf_filepath, sqpoll=args.sqpoll, parallel_sweep=args.parallel_sweep, threads=args.threads)
 
     elif args.operation == 'perf+fill':
-        sweetspot_byte_array = create_byte_array_high_throughput(data_filepath=args.data_filepath, perf_filepath=args.perf_filepath, fill=args.fill)
-        write_byte_array_contiguously(sweetspot_byte_array, data_filepath=args.data_filepath)
+        sweetspot_byte_array = create_byte_array_high_throughput(data_filepath=args.data_filepath, perf_filepath=args.perf_filepath, fill=args.fill, sqpoll=args.sqpoll, parallel_sweep=args.parallel_sweep, threads=args.threads)
+        write_byte_array_contiguously(sweetspot_byte_array, data_filepath=args.data_filepath, direct_io=args.direct_io, sqpoll=args.sqpoll, copy_file_range=args.copy_file_range)
 
     elif args.operation in ['fill', 'loop']:
         byte_array = create_bytearray_killobytes(args.size, fill=args.fill)
         if args.operation == 'fill':
-            write_byte_array_contiguously(byte_array, data_filepath=args.data_filepath)
+            write_byte_array_contiguously(byte_array, data_filepath=args.data_filepath, direct_io=args.direct_io, sqpoll=args.sqpoll, copy_file_range=args.copy_file_range)
         elif args.operation == 'loop':
-            write_byte_array_continuously(byte_array, data_filepath=args.data_filepath, duration=args.duration, iterations=args.iterations)
+            write_byte_array_continuously(byte_array, data_filepath=args.data_filepath, duration=args.duration, iterations=args.iterations, sqpoll=args.sqpoll, threads=args.threads)
 
     elif args.operation == 'write':
         generate_and_write_bytearray(args.size, fill=args.fill, no_optimizations=args.no_optimizations, data_filepath=args.data_filepath)
 
     elif args.operation == 'perf+write':
-        sweetspot_byte_array = create_byte_array_high_throughput(data_filepath=args.data_filepath, perf_filepath=args.perf_filepath, fill=args.fill)
+        sweetspot_byte_array = create_byte_array_high_throughput(data_filepath=args.data_filepath, perf_filepath=args.perf_filepath, fill=args.fill, parallel_sweep=args.parallel_sweep, threads=args.threads)
         write_bytearray_to_disk(sweetspot_byte_array, size=args.size, data_filepath=args.data_filepath)
 
     logging.info('done %r', args.operation)